@@ -0,0 +1,15 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Process-wide nibabel settings, applied on import.
+
+``fmriprep`` preloads this module in the multiprocessing forkserver, so
+that every process forked from it (including nipype's workers) inherits
+the settings without ``fmriprep.cli.run`` having to import nibabel at
+module level.
+"""
+import nibabel
+
+nibabel.arrayproxy.KEEP_FILE_OPEN_DEFAULT = 'auto'
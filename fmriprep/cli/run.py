@@ -11,27 +11,163 @@ import os.path as op
 import logging
 import sys
 import gc
-import uuid
 import warnings
 from argparse import ArgumentParser
 from argparse import RawTextHelpFormatter
+from copy import deepcopy
+from functools import lru_cache
 from multiprocessing import cpu_count
-from time import strftime
-import nibabel
-
-nibabel.arrayproxy.KEEP_FILE_OPEN_DEFAULT = 'auto'
 
 logging.addLevelName(25, 'IMPORTANT')  # Add a new level between INFO and WARNING
 logging.addLevelName(15, 'VERBOSE')  # Add a new level between INFO and DEBUG
 logger = logging.getLogger('cli')
 
+# Map -v occurrences to logging levels (-vvv and beyond is DEBUG)
+_LOG_LEVELS = (25, logging.INFO, 15, logging.DEBUG)
+
 
 def _warn_redirect(message, category, filename, lineno, file=None, line=None):
     logger.warning('Captured warning (%s): %s', category, message)
 
 
+def _cgroup_quota(root='/sys/fs/cgroup'):
+    """
+    Number of CPUs allowed by the cgroup (v2 or v1) CPU bandwidth quota,
+    or ``None`` if no quota is set (or cgroups are not available).
+
+    """
+    try:  # cgroup v2
+        with open(op.join(root, 'cpu.max')) as fobj:
+            quota, period = fobj.read().split()[:2]
+    except (OSError, ValueError):
+        try:  # cgroup v1
+            with open(op.join(root, 'cpu', 'cpu.cfs_quota_us')) as fobj:
+                quota = fobj.read().strip()
+            with open(op.join(root, 'cpu', 'cpu.cfs_period_us')) as fobj:
+                period = fobj.read().strip()
+        except OSError:
+            return None
+
+    if quota in ('max', '-1'):
+        return None
+    try:
+        return max(int(int(quota) / int(period)), 1)
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def _effective_cpus():
+    """
+    Number of CPUs this process may actually use, honoring CPU affinity
+    masks (e.g. SLURM, ``taskset``) and container CPU quotas, which
+    ``multiprocessing.cpu_count()`` ignores.
+
+    """
+    try:
+        ncpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on macOS
+        ncpus = cpu_count()
+
+    quota = _cgroup_quota()
+    if quota is not None:
+        ncpus = min(ncpus, quota)
+    return ncpus
+
+
+def _parse_cpulist(cpulist):
+    """Expand a sysfs CPU list (e.g. ``0-3,8-11``) into a set of CPU ids"""
+    cpus = set()
+    for chunk in cpulist.strip().split(','):
+        if not chunk:
+            continue
+        first, _, last = chunk.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def _numa_node_cpus(sysfs='/sys/devices/system/node'):
+    """
+    Largest number of CPUs this process may use within a single NUMA node
+    (i.e., each node's CPUs intersected with the affinity mask), or ``None``
+    if the NUMA topology cannot be determined.
+
+    """
+    from glob import glob
+    try:
+        allowed = os.sched_getaffinity(0)
+    except AttributeError:  # Not available on macOS
+        allowed = None
+
+    node_cpus = []
+    for cpulist in glob(op.join(sysfs, 'node[0-9]*', 'cpulist')):
+        try:
+            with open(cpulist) as fobj:
+                cpus = _parse_cpulist(fobj.read())
+        except (OSError, ValueError):
+            continue
+        if allowed is not None:
+            cpus &= allowed
+        node_cpus.append(len(cpus))
+
+    if not node_cpus:
+        return None
+    return max(node_cpus) or None
+
+
+def _new_run_uuid():
+    """Generate a run identifier (timestamp and random UUID)"""
+    import uuid
+    from time import strftime
+    return '{}_{}'.format(strftime('%Y%m%d-%H%M%S'), uuid.uuid4().hex)
+
+
+def _abspath(path):
+    """Make ``path`` absolute, skipping the ``getcwd()`` call if it already is"""
+    return path if op.isabs(path) else op.abspath(path)
+
+
+def _makedirs(path):
+    """Create ``path``, only walking up its parents when they are missing"""
+    try:
+        os.mkdir(path)
+    except FileExistsError:
+        if not op.isdir(path):
+            raise
+    except FileNotFoundError:
+        os.makedirs(path, exist_ok=True)
+
+
+def _nipype_option_changed(ncfg, section, key, value):
+    """
+    Whether setting ``key`` to ``value`` would change nipype's configuration.
+    nipype stores options as strings, with booleans in lowercase.
+
+    """
+    current = ncfg.get(section, key)
+    if current is None:
+        return True
+    if isinstance(value, bool):
+        return current.lower() != str(value).lower()
+    return current != str(value)
+
+
+@lru_cache(maxsize=8)
+def _load_plugin_settings(path, mtime):
+    """
+    Parse a nipype plugin configuration file with the safe YAML loader
+    (libyaml-backed when available). ``mtime`` is only part of the cache key,
+    so that edited files are parsed again.
+
+    """
+    import yaml
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    with open(path) as f:
+        return yaml.load(f, Loader=loader)
+
+
+@lru_cache(maxsize=1)
 def get_parser():
-    """Build parser object"""
+    """Build parser object (built once and cached for subsequent calls)"""
     from ..info import __version__
 
     verstr = 'fmriprep v{}'.format(__version__)
@@ -203,20 +339,48 @@ def get_parser():
     return parser
 
 
+def _validate_opts(opts, parser):
+    """Check option combinations, exiting through ``parser.error`` if invalid"""
+    # ERROR check if use_aroma was specified, but the correct template was not
+    if opts.use_aroma and (opts.template != 'MNI152NLin2009cAsym' or
+                           'template' not in opts.output_space):
+        parser.error('--use-aroma requires functional images to be resampled to '
+                     'MNI152NLin2009cAsym.\n'
+                     '\t--template must be set to "MNI152NLin2009cAsym" (was: "{}")\n'
+                     '\t--output-space list must include "template" (was: "{}")'.format(
+                         opts.template, ' '.join(opts.output_space)))
+    # Check output_space
+    if 'template' not in opts.output_space and (opts.use_syn_sdc or opts.force_syn):
+        msg = ('SyN SDC correction requires T1 to MNI registration, but '
+               '"template" is not specified in "--output-space" arguments')
+        if opts.force_syn:
+            parser.error(msg)
+        logger.warning(msg)
+
+    if 1 < opts.nthreads < opts.omp_nthreads:
+        logger.warning(
+            'Per-process threads (--omp-nthreads=%d) exceed total '
+            'threads (--nthreads/--n_cpus=%d)', opts.omp_nthreads, opts.nthreads)
+
+
 def main():
     """Entry point"""
-    from niworkflows.nipype import logging as nlogging
-    from multiprocessing import set_start_method, Process, Manager
-    from ..viz.reports import generate_reports
+    from multiprocessing import (
+        set_start_method, set_forkserver_preload, get_start_method, Process, Pipe)
     set_start_method('forkserver')
+    # Apply nibabel settings in the forkserver, and thus in all workers
+    set_forkserver_preload(['__main__', 'fmriprep.cli.nibabel_setup'])
 
     warnings.showwarning = _warn_redirect
-    opts = get_parser().parse_args()
+    parser = get_parser()
+    opts = parser.parse_args()
+    _validate_opts(opts, parser)
 
     # FreeSurfer license
-    default_license = op.join(os.getenv('FREESURFER_HOME', ''), 'license.txt')
-    # Precedence: --fs-license-file, $FS_LICENSE, default_license
-    license_file = opts.fs_license_file or os.getenv('FS_LICENSE', default_license)
+    # Precedence: --fs-license-file, $FS_LICENSE, $FREESURFER_HOME/license.txt
+    # (--fs-license-file is made absolute by the parser already)
+    license_file = (opts.fs_license_file or os.getenv('FS_LICENSE') or
+                    op.join(os.getenv('FREESURFER_HOME', ''), 'license.txt'))
     if not os.path.exists(license_file):
         raise RuntimeError(
             'ERROR: a valid license file is required for FreeSurfer to run. '
@@ -227,30 +391,57 @@ def main():
             'surfer.nmr.mgh.harvard.edu/registration.html')
     os.environ['FS_LICENSE'] = license_file
 
+    # Heavy imports are deferred so that --help and --version return quickly
+    from . import nibabel_setup  # noqa
+    from niworkflows.nipype import logging as nlogging
+    from ..viz.reports import generate_reports
+
     # Retrieve logging level
-    log_level = int(max(25 - 5 * opts.verbose_count, logging.DEBUG))
+    log_level = _LOG_LEVELS[min(opts.verbose_count, len(_LOG_LEVELS) - 1)]
     # Set logging
     logger.setLevel(log_level)
-    nlogging.getLogger('workflow').setLevel(log_level)
-    nlogging.getLogger('interface').setLevel(log_level)
-    nlogging.getLogger('utils').setLevel(log_level)
+    for name in ('workflow', 'interface', 'utils'):
+        nlogger = nlogging.getLogger(name)
+        if nlogger.level != log_level:
+            nlogger.setLevel(log_level)
 
     errno = 0
 
-    # Call build_workflow(opts, retval)
-    with Manager() as mgr:
-        retval = mgr.dict()
-        p = Process(target=build_workflow, args=(opts, retval))
-        p.start()
-        p.join()
-
-        fmriprep_wf = retval['workflow']
-        plugin_settings = retval['plugin_settings']
-        output_dir = retval['output_dir']
-        work_dir = retval['work_dir']
-        subject_list = retval['subject_list']
-        run_uuid = retval['run_uuid']
-        retcode = retval['return_code']
+    # Called with reports only: no workflow needs to be built
+    if opts.reports_only:
+        from ..utils.bids import collect_participants
+        subject_list = collect_participants(
+            opts.bids_dir, participant_label=opts.participant_label)
+        if logger.isEnabledFor(25):
+            logger.log(25, 'Running --reports-only on participants %s', ', '.join(subject_list))
+        errno = generate_reports(subject_list,
+                                 _abspath(opts.output_dir),
+                                 _abspath(opts.work_dir or 'work'),
+                                 opts.run_uuid or _new_run_uuid())
+        sys.exit(int(errno > 0))
+
+    # Call build_workflow(opts, retval) in a separate process, and receive
+    # the results through a one-way pipe (a single pickling pass)
+    recv_conn, send_conn = Pipe(duplex=False)
+    p = Process(target=_build_workflow_proc, args=(opts, send_conn))
+    p.start()
+    send_conn.close()
+    try:
+        retval = recv_conn.recv()
+    except EOFError:  # The child died before sending anything back
+        retval = {}
+    recv_conn.close()
+    p.join()
+
+    if 'return_code' not in retval:  # build_workflow failed early
+        sys.exit(1)
+
+    fmriprep_wf = retval['workflow']
+    plugin_settings = retval['plugin_settings']
+    output_dir = retval['output_dir']
+    work_dir = retval['work_dir']
+    subject_list = retval['subject_list']
+    run_uuid = retval['run_uuid']
 
     if fmriprep_wf is None:
         sys.exit(1)
@@ -258,11 +449,10 @@ def main():
     if opts.write_graph:
         fmriprep_wf.write_graph(graph2use="colored", format='svg', simple_form=True)
 
-    if opts.reports_only:
-        sys.exit(int(retcode > 0))
-
-    # Clean up master process before running workflow, which may create forks
-    gc.collect()
+    # Clean up master process before running workflow, which may create forks.
+    # With forkserver, workers do not inherit the master's heap, so skip it.
+    if get_start_method() == 'fork':
+        gc.collect()
     try:
         fmriprep_wf.run(**plugin_settings)
     except RuntimeError as e:
@@ -276,6 +466,16 @@ def main():
     sys.exit(int(errno > 0))
 
 
+def _build_workflow_proc(opts, conn):
+    """Run :func:`build_workflow` and send its results back through ``conn``"""
+    retval = {}
+    try:
+        build_workflow(opts, retval)
+    finally:
+        conn.send(retval)
+        conn.close()
+
+
 def build_workflow(opts, retval):
     """
     Create the Nipype Workflow that supports the whole execution
@@ -285,53 +485,41 @@ def build_workflow(opts, retval):
     inside this function that has pickleable inputs and output
     dictionary (``retval``) to allow isolation using a
     ``multiprocessing.Process`` that allows fmriprep to enforce
-    a hard-limited memory-scope.
+    a hard-limited memory-scope. The filled-in ``retval`` is sent
+    back to the parent through a ``multiprocessing.Pipe``.
 
     """
     from niworkflows.nipype import logging, config as ncfg
     from ..info import __version__
     from ..workflows.base import init_fmriprep_wf
     from ..utils.bids import collect_participants
-    from ..viz.reports import generate_reports
 
     logger = logging.getLogger('workflow')
 
     INIT_MSG = """
-    Running fMRIPREP version {version}:
-      * BIDS dataset path: {bids_dir}.
-      * Participant list: {subject_list}.
-      * Run identifier: {uuid}.
-    """.format
-
-    # Validity of some inputs
-    # ERROR check if use_aroma was specified, but the correct template was not
-    if opts.use_aroma and (opts.template != 'MNI152NLin2009cAsym' or
-                           'template' not in opts.output_space):
-        raise RuntimeError('ERROR: --use-aroma requires functional images to be resampled to '
-                           'MNI152NLin2009cAsym.\n'
-                           '\t--template must be set to "MNI152NLin2009cAsym" (was: "{}")\n'
-                           '\t--output-space list must include "template" (was: "{}")'.format(
-                               opts.template, ' '.join(opts.output_space)))
-    # Check output_space
-    if 'template' not in opts.output_space and (opts.use_syn_sdc or opts.force_syn):
-        msg = ('SyN SDC correction requires T1 to MNI registration, but '
-               '"template" is not specified in "--output-space" arguments')
-        if opts.force_syn:
-            raise RuntimeError(msg)
-        logger.warning(msg)
+    Running fMRIPREP version %s:
+      * BIDS dataset path: %s.
+      * Participant list: %s.
+      * Run identifier: %s.
+    """
 
     # Set up some instrumental utilities
-    run_uuid = '%s_%s' % (strftime('%Y%m%d-%H%M%S'), uuid.uuid4())
+    run_uuid = _new_run_uuid()
 
     # First check that bids_dir looks like a BIDS folder
-    bids_dir = op.abspath(opts.bids_dir)
+    bids_dir = _abspath(opts.bids_dir)
     subject_list = collect_participants(
         bids_dir, participant_label=opts.participant_label)
 
     # Setting up MultiProc
+    ncpus = _effective_cpus()
     nthreads = opts.nthreads
     if nthreads < 1:
-        nthreads = cpu_count()
+        nthreads = ncpus
+    elif nthreads > ncpus:
+        logger.warning(
+            'Total threads (--nthreads/--n_cpus=%d) exceed the %d CPUs available '
+            'to this process', nthreads, ncpus)
 
     plugin_settings = {
         'plugin': 'MultiProc',
@@ -347,47 +535,75 @@ def build_workflow(opts, retval):
 
     # Overload plugin_settings if --use-plugin
     if opts.use_plugin is not None:
-        from yaml import load as loadyml
-        with open(opts.use_plugin) as f:
-            plugin_settings = loadyml(f)
+        plugin_settings = deepcopy(_load_plugin_settings(
+            opts.use_plugin, op.getmtime(opts.use_plugin)))
+
+    # Seconds between polls of the job queue: short for local execution,
+    # longer for cluster schedulers. Can be overridden with $FMRIPREP_POLL_SLEEP
+    poll_sleep = 30 if plugin_settings.get('plugin') in (
+        'SGE', 'SGEGraph', 'PBS', 'PBSGraph') else 2
+    if os.getenv('FMRIPREP_POLL_SLEEP'):
+        try:
+            poll_sleep = float(os.getenv('FMRIPREP_POLL_SLEEP'))
+        except ValueError:
+            logger.warning('Ignoring invalid $FMRIPREP_POLL_SLEEP value "%s" (using %g s)',
+                           os.getenv('FMRIPREP_POLL_SLEEP'), poll_sleep)
+    # An empty "plugin_args:" entry in a --use-plugin file is loaded as None
+    if plugin_settings.get('plugin_args') is None:
+        plugin_settings['plugin_args'] = {}
+    plugin_settings['plugin_args'].setdefault('poll_sleep_duration', poll_sleep)
 
     omp_nthreads = opts.omp_nthreads
     if omp_nthreads == 0:
-        omp_nthreads = min(nthreads - 1 if nthreads > 1 else cpu_count(), 8)
+        # Keep per-process threads within a single NUMA node (socket), so that
+        # OpenMP-parallel tools (ANTs, wb_command) do not straddle sockets
+        omp_nthreads = min(nthreads - 1 if nthreads > 1 else ncpus, 8,
+                           _numa_node_cpus() or ncpus)
 
-    if 1 < nthreads < omp_nthreads:
+    # Explicitly set --nthreads was already checked by _validate_opts
+    if opts.nthreads < 1 and 1 < nthreads < omp_nthreads:
         logger.warning(
             'Per-process threads (--omp-nthreads=%d) exceed total '
             'threads (--nthreads/--n_cpus=%d)', omp_nthreads, nthreads)
 
     # Set up directories
-    output_dir = op.abspath(opts.output_dir)
+    output_dir = _abspath(opts.output_dir)
     log_dir = op.join(output_dir, 'fmriprep', 'logs')
-    work_dir = op.abspath(opts.work_dir or 'work')  # Set work/ as default
+    work_dir = _abspath(opts.work_dir or 'work')  # Set work/ as default
 
     # Check and create output and working directories
-    os.makedirs(output_dir, exist_ok=True)
-    os.makedirs(log_dir, exist_ok=True)
-    os.makedirs(work_dir, exist_ok=True)
+    for path in (output_dir, log_dir, work_dir):
+        _makedirs(path)
 
     # Nipype config (logs and execution)
-    ncfg.update_config({
+    stop_on_first_crash = opts.stop_on_first_crash or opts.work_dir is None
+    nipype_config = {
         'logging': {
             'log_directory': log_dir,
-            'log_to_file': True
+            # Only write pypeline.log when verbosity is INFO or higher
+            'log_to_file': opts.verbose_count > 0,
         },
         'execution': {
             'crashdump_dir': log_dir,
-            'crashfile_format': 'txt',
+            # Many nodes may crash concurrently when not stopping on the first
+            # crash; pickled crashfiles are faster to write than text ones
+            'crashfile_format': 'txt' if stop_on_first_crash else 'pklz',
             'get_linked_libs': False,
-            'stop_on_first_crash': opts.stop_on_first_crash or opts.work_dir is None,
+            'poll_sleep_duration': plugin_settings['plugin_args']['poll_sleep_duration'],
+            'stop_on_first_crash': stop_on_first_crash,
         },
         'monitoring': {
             'enabled': opts.resource_monitor,
             'sample_frequency': '0.5',
             'summary_append': True,
         }
-    })
+    }
+    # Only update the configuration if some setting differs from the current
+    # one (update_config ignores the monitoring section, so it is not checked)
+    if any(_nipype_option_changed(ncfg, section, key, val)
+           for section in ('logging', 'execution')
+           for key, val in nipype_config[section].items()):
+        ncfg.update_config(nipype_config)
 
     if opts.resource_monitor:
         ncfg.enable_resource_monitor()
@@ -400,21 +616,8 @@ def build_workflow(opts, retval):
     retval['run_uuid'] = run_uuid
     retval['workflow'] = None
 
-    # Called with reports only
-    if opts.reports_only:
-        logger.log(25, 'Running --reports-only on participants %s', ', '.join(subject_list))
-        if opts.run_uuid is not None:
-            run_uuid = opts.run_uuid
-        retval['return_code'] = generate_reports(subject_list, output_dir, work_dir, run_uuid)
-        return retval
-
     # Build main workflow
-    logger.log(25, INIT_MSG(
-        version=__version__,
-        bids_dir=bids_dir,
-        subject_list=subject_list,
-        uuid=run_uuid)
-    )
+    logger.log(25, INIT_MSG, __version__, bids_dir, subject_list, run_uuid)
 
     retval['workflow'] = init_fmriprep_wf(
         subject_list=subject_list,
@@ -0,0 +1,100 @@
+''' Testing module for fmriprep.cli.run '''
+import os
+
+import pytest
+
+from .. import run
+
+
+@pytest.mark.parametrize('files,expected', [
+    ({'cpu.max': 'max 100000\n'}, None),
+    ({'cpu.max': '150000 100000\n'}, 1),  # Fractional quotas round down
+    ({'cpu.max': '50000 100000\n'}, 1),  # ... but never below one CPU
+    ({'cpu.max': '400000 100000\n'}, 4),
+    ({'cpu.max': '400000 0\n'}, None),
+    ({'cpu.max': 'garbage\n'}, None),
+    ({'cpu/cpu.cfs_quota_us': '-1\n', 'cpu/cpu.cfs_period_us': '100000\n'}, None),
+    ({'cpu/cpu.cfs_quota_us': '200000\n', 'cpu/cpu.cfs_period_us': '100000\n'}, 2),
+    ({'cpu/cpu.cfs_quota_us': 'garbage\n', 'cpu/cpu.cfs_period_us': '100000\n'}, None),
+    ({}, None),
+])
+def test_cgroup_quota(tmpdir, files, expected):
+    for name, content in files.items():
+        tmpdir.join(name).write(content, ensure=True)
+    assert run._cgroup_quota(str(tmpdir)) == expected
+
+
+def test_cgroup_quota_missing(tmpdir):
+    assert run._cgroup_quota(str(tmpdir.join('missing'))) is None
+
+
+def _fake_sysfs(root, nodes):
+    for i, cpulist in enumerate(nodes):
+        node = root.mkdir('node%d' % i)
+        node.join('cpulist').write(cpulist + '\n')
+    return str(root)
+
+
+@pytest.mark.parametrize('affinity,expected', [
+    (set(range(16)), 4),  # Whole host
+    (set(range(8, 12)), 4),  # Allocation within one node
+    ({0, 1, 4, 5, 6}, 3),  # Allocation spanning two nodes
+])
+def test_numa_node_cpus(tmpdir, monkeypatch, affinity, expected):
+    sysfs = _fake_sysfs(tmpdir, ['0-3', '4-7', '8-11', '12-15'])
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: affinity, raising=False)
+    assert run._numa_node_cpus(sysfs) == expected
+
+
+def test_numa_node_cpus_single_node(tmpdir, monkeypatch):
+    # 8 of 32 CPUs granted, all on one node of a 4-node host
+    sysfs = _fake_sysfs(tmpdir, ['0-7', '8-15', '16-23', '24-31'])
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: set(range(8, 16)),
+                        raising=False)
+    assert run._numa_node_cpus(sysfs) == 8
+
+
+def test_numa_node_cpus_no_sysfs(tmpdir):
+    assert run._numa_node_cpus(str(tmpdir.join('missing'))) is None
+
+
+def test_parse_cpulist():
+    assert run._parse_cpulist('0-2,5,8-9\n') == {0, 1, 2, 5, 8, 9}
+    assert run._parse_cpulist('') == set()
+
+
+def test_makedirs(tmpdir):
+    target = tmpdir.join('a', 'b')
+    run._makedirs(str(target))
+    assert target.check(dir=True)
+    run._makedirs(str(target))  # Existing folders are fine
+
+    afile = tmpdir.join('afile')
+    afile.write('')
+    with pytest.raises(FileExistsError):
+        run._makedirs(str(afile))
+
+
+class _FakeConfig(object):
+    def __init__(self, options):
+        self.options = options
+
+    def get(self, section, key, default=None):
+        return self.options.get((section, key), default)
+
+
+@pytest.mark.parametrize('key,value,expected', [
+    ('log_to_file', False, False),  # Stored as 'false'
+    ('log_to_file', True, True),
+    ('crashfile_format', 'pklz', False),
+    ('crashfile_format', 'txt', True),
+    ('poll_sleep_duration', 2.0, False),
+    ('get_linked_libs', False, True),  # Not among nipype's defaults
+])
+def test_nipype_option_changed(key, value, expected):
+    ncfg = _FakeConfig({
+        ('logging', 'log_to_file'): 'false',
+        ('logging', 'crashfile_format'): 'pklz',
+        ('logging', 'poll_sleep_duration'): '2.0',
+    })
+    assert run._nipype_option_changed(ncfg, 'logging', key, value) is expected
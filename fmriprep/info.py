@@ -67,7 +67,7 @@ REQUIRES = [
     'sklearn',
     'nibabel>=2.1.0',
     'pandas',
-    'grabbit',
+    'grabbit>=0.1.2',
     'pybids>=0.5',
     'nitime',
     'niworkflows>=0.3.4',
@@ -16,7 +16,9 @@ Fetch some test data
 """
 import os
 import re
+import hashlib
 import os.path as op
+import tempfile
 import warnings
 from itertools import groupby
 from bids.grabbids import BIDSLayout
@@ -39,6 +41,18 @@ class BIDSWarning(RuntimeWarning):
     pass
 
 
+class _IndexedBIDSLayout(BIDSLayout):
+    """
+    A ``BIDSLayout`` populated from an index saved with ``save_index()``.
+
+    Saved indexes store entities by id (e.g. ``bids.subject``), which queries
+    by name do not match, so entities are always re-parsed from the stored
+    paths (this still skips walking the filesystem).
+    """
+    def load_index(self, filename, reindex=True):
+        return super(_IndexedBIDSLayout, self).load_index(filename, reindex=reindex)
+
+
 def collect_participants(bids_dir, participant_label=None, strict=False):
     """
     List the participants under the BIDS root and checks that participants
@@ -75,9 +89,11 @@ def collect_participants(bids_dir, participant_label=None, strict=False):
 
     """
     bids_dir = op.abspath(bids_dir)
+    # os.scandir gets the entry type from the directory listing itself,
+    # avoiding a stat call per entry
     all_participants = sorted(
-        [subdir[4:] for subdir in os.listdir(bids_dir)
-         if op.isdir(op.join(bids_dir, subdir)) and subdir.startswith('sub-')])
+        [entry.name[4:] for entry in os.scandir(bids_dir)
+         if entry.name.startswith('sub-') and entry.is_dir()])
 
     # Error: bids_dir does not contain subjects
     if not all_participants:
@@ -117,10 +133,83 @@ def collect_participants(bids_dir, participant_label=None, strict=False):
     return found_label
 
 
-def collect_data(dataset, participant_label, task=None):
+def _layout_exclude(dataset, participant_label):
+    """
+    Build the list of regular expressions that keep the BIDS layout from
+    indexing folders fmriprep will never query: other participants,
+    modalities other than anat/func/fmap, and non-data top-level folders.
+
+    >>> patterns = _layout_exclude('/data/ds', ['01', 'sub-02'])
+    >>> [bool(re.search(pat, '/data/ds/sub-03')) for pat in patterns]
+    [True, False, False]
+    >>> any(re.search(pat, '/data/ds/sub-01/sub-01_sessions.tsv')
+    ...     for pat in patterns)
+    False
+    >>> any(re.search(pat, '/data/ds/sub-01/ses-1/dwi') for pat in patterns)
+    True
+    >>> any(re.search(pat, '/data/ds/code') for pat in patterns)
+    True
+
+    """
+    if isinstance(participant_label, str):
+        participant_label = [participant_label]
+
+    root = re.escape(op.abspath(dataset) + os.sep)
+    labels = '|'.join(re.escape(sub[4:] if sub.startswith('sub-') else sub)
+                      for sub in participant_label)
+    return [
+        # Participants other than those requested
+        root + r'sub-(?!(?:%s)(?![a-zA-Z0-9]))[a-zA-Z0-9]+' % labels,
+        # Modalities fmriprep does not use
+        root + r'sub-[a-zA-Z0-9]+/(?:ses-[a-zA-Z0-9]+/)?(?:dwi|eeg|ieeg|meg|perf|beh)(?:/|$)',
+        # Non-data folders and hidden files
+        root + r'(?:code|stimuli|sourcedata|models)(?:/|$)|' + root + r'\.',
+    ]
+
+
+def _layout_fingerprint(dataset, participant_label):
+    """
+    Hash the state of the dataset as seen by a participant's layout: the
+    modification times of ``dataset_description.json``, of the dataset root
+    (top-level inherited sidecars) and of every folder under the participant's
+    root (adding, removing or renaming any file updates the mtime of its
+    parent folder).
+
+    """
+    dataset = op.abspath(dataset)
+    subject_dir = op.join(dataset, 'sub-' + participant_label)
+    stamps = [dataset, participant_label, str(op.getmtime(dataset)),
+              str(op.getmtime(op.join(dataset, 'dataset_description.json')))]
+    for root, _, _ in os.walk(subject_dir):
+        stamps.append('%s:%s' % (root, op.getmtime(root)))
+    return hashlib.sha1('\n'.join(stamps).encode()).hexdigest()
+
+
+def _save_index(layout, index_file):
+    """
+    Save the layout's index atomically, so that interrupted or concurrent
+    runs never leave a partially written file at ``index_file``.
+
+    """
+    index_dir = op.dirname(index_file)
+    os.makedirs(index_dir, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=index_dir, suffix='.tmp')
+    os.close(fd)
+    try:
+        layout.save_index(tmp_file)
+        os.replace(tmp_file, index_file)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+
+def collect_data(dataset, participant_label, task=None, index_dir=None):
     """
     Uses grabbids to retrieve the input data for a given participant
 
+    If ``index_dir`` is given, the layout index is saved there and reused
+    by subsequent calls as long as the dataset has not changed.
+
     >>> bids_root, _ = collect_data('ds054', '100185')
     >>> bids_root['fmap']  # doctest: +ELLIPSIS
     ['.../ds054/sub-100185/fmap/sub-100185_magnitude1.nii.gz', \
@@ -151,7 +240,29 @@ def collect_data(dataset, participant_label, task=None):
 
 
     """
-    layout = BIDSLayout(dataset)
+    layout_kwargs = {'exclude': _layout_exclude(dataset, participant_label)}
+    index_file = None
+    if index_dir is not None:
+        index_file = op.join(
+            index_dir, _layout_fingerprint(dataset, participant_label) + '.json')
+
+    layout = None
+    if index_file is not None and op.isfile(index_file):
+        try:
+            layout = _IndexedBIDSLayout(dataset, index=index_file, **layout_kwargs)
+        except (ValueError, OSError):
+            # Damaged index (e.g. interrupted write): drop it and re-index
+            warnings.warn('Ignoring unreadable BIDS layout index "%s"' % index_file,
+                          BIDSWarning)
+            try:
+                os.remove(index_file)
+            except OSError:
+                pass
+
+    if layout is None:
+        layout = BIDSLayout(dataset, **layout_kwargs)
+        if index_file is not None:
+            _save_index(layout, index_file)
     queries = {
         'fmap': {'subject': participant_label, 'modality': 'fmap',
                  'extensions': ['nii', 'nii.gz']},
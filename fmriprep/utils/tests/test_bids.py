@@ -0,0 +1,69 @@
+''' Testing module for fmriprep.utils.bids '''
+import os
+import json
+
+import pytest
+
+from ..bids import collect_data, BIDSWarning
+
+
+def _touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w'):
+        pass
+
+
+def _make_dataset(root):
+    with open(os.path.join(root, 'dataset_description.json'), 'w') as fobj:
+        json.dump({'Name': 'test', 'BIDSVersion': '1.0.2'}, fobj)
+    for sub in ('01', '02'):
+        _touch(os.path.join(root, 'sub-%s' % sub, 'anat', 'sub-%s_T1w.nii.gz' % sub))
+        _touch(os.path.join(root, 'sub-%s' % sub, 'func',
+                            'sub-%s_task-rest_bold.nii.gz' % sub))
+        _touch(os.path.join(root, 'sub-%s' % sub, 'fmap',
+                            'sub-%s_phasediff.nii.gz' % sub))
+
+
+def test_collect_data_index(tmpdir):
+    bids_dir = tmpdir.mkdir('ds')
+    index_dir = str(tmpdir.join('index'))
+    _make_dataset(str(bids_dir))
+
+    fresh, _ = collect_data(str(bids_dir), '01')
+    first, _ = collect_data(str(bids_dir), '01', index_dir=index_dir)
+    assert len(os.listdir(index_dir)) == 1
+    # Second call is served from the saved index
+    cached, _ = collect_data(str(bids_dir), '01', index_dir=index_dir)
+    assert len(os.listdir(index_dir)) == 1
+
+    assert fresh['bold'] and fresh['t1w'] and fresh['fmap']
+    assert first == fresh
+    assert cached == fresh
+
+    # Adding a top-level sidecar invalidates the saved index
+    with open(str(bids_dir.join('task-rest_bold.json')), 'w') as fobj:
+        json.dump({'RepetitionTime': 2.0}, fobj)
+    os.utime(str(bids_dir), (0, 0))
+    collect_data(str(bids_dir), '01', index_dir=index_dir)
+    assert len(os.listdir(index_dir)) == 2
+
+
+def test_collect_data_damaged_index(tmpdir):
+    bids_dir = tmpdir.mkdir('ds')
+    index_dir = str(tmpdir.join('index'))
+    _make_dataset(str(bids_dir))
+
+    fresh, _ = collect_data(str(bids_dir), '01', index_dir=index_dir)
+    index_file = os.path.join(index_dir, os.listdir(index_dir)[0])
+    # Truncate the saved index, as an interrupted write would
+    with open(index_file, 'r+') as fobj:
+        fobj.truncate(os.path.getsize(index_file) // 2)
+
+    with pytest.warns(BIDSWarning):
+        recovered, _ = collect_data(str(bids_dir), '01', index_dir=index_dir)
+    assert recovered == fresh
+
+    # The damaged index was replaced by a valid one
+    assert os.listdir(index_dir) == [os.path.basename(index_file)]
+    cached, _ = collect_data(str(bids_dir), '01', index_dir=index_dir)
+    assert cached == fresh
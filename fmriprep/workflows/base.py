@@ -176,6 +176,7 @@ def init_fmriprep_wf(subject_list, task_id, run_uuid,
                                                    t2s_coreg=t2s_coreg,
                                                    omp_nthreads=omp_nthreads,
                                                    skull_strip_template=skull_strip_template,
+                                                   work_dir=work_dir,
                                                    reportlets_dir=reportlets_dir,
                                                    output_dir=output_dir,
                                                    bids_dir=bids_dir,
@@ -210,10 +211,11 @@ def init_fmriprep_wf(subject_list, task_id, run_uuid,
 
 def init_single_subject_wf(subject_id, task_id, name,
                            ignore, debug, low_mem, anat_only, longitudinal, t2s_coreg,
-                           omp_nthreads, skull_strip_template, reportlets_dir, output_dir,
-                           bids_dir, freesurfer, output_spaces, template, medial_surface_nan,
-                           hires, use_bbr, bold2t1w_dof, fmap_bspline, fmap_demean, use_syn,
-                           force_syn, output_grid_ref, use_aroma, ignore_aroma_err):
+                           omp_nthreads, skull_strip_template, work_dir, reportlets_dir,
+                           output_dir, bids_dir, freesurfer, output_spaces, template,
+                           medial_surface_nan, hires, use_bbr, bold2t1w_dof, fmap_bspline,
+                           fmap_demean, use_syn, force_syn, output_grid_ref, use_aroma,
+                           ignore_aroma_err):
     """
     This workflow organizes the preprocessing pipeline for a single subject.
     It collects and reports information about the subject, and prepares
@@ -236,6 +238,7 @@ def init_single_subject_wf(subject_id, task_id, name,
                                     t2s_coreg=False,
                                     omp_nthreads=1,
                                     freesurfer=True,
+                                    work_dir='.',
                                     reportlets_dir='.',
                                     output_dir='.',
                                     bids_dir='.',
@@ -284,6 +287,8 @@ def init_single_subject_wf(subject_id, task_id, name,
             Maximum number of threads an individual process may use
         skull_strip_template : str
             Name of ANTs skull-stripping template ('OASIS' or 'NKI')
+        work_dir : str
+            Directory in which to store workflow execution state and temporary files
         reportlets_dir : str
             Directory in which to save reportlets
         output_dir : str
@@ -343,7 +348,8 @@ def init_single_subject_wf(subject_id, task_id, name,
         }
         layout = None
     else:
-        subject_data, layout = collect_data(bids_dir, subject_id, task_id)
+        subject_data, layout = collect_data(
+            bids_dir, subject_id, task_id, index_dir=os.path.join(work_dir, '.bids_cache'))
 
     # Make sure we always go through these two checks
     if not anat_only and subject_data['bold'] == []: